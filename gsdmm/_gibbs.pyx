@@ -0,0 +1,114 @@
+# cython: language_level=3, boundscheck=False, wraparound=False, cdivision=True
+'''
+Ahead of time compiled version of the Gibbs sampling pass in gsdmm/mgp_array.py, for installs
+that shouldn't rely on the numba JIT. Both kernels must stay in sync.
+'''
+from libc.math cimport exp, lgamma, log
+from libc.stdint cimport int64_t
+
+import numpy as np
+
+
+cpdef int gibbs_iter(const int64_t[::1] doc_offsets, const int[::1] words, const int[::1] counts,
+                     int[::1] d_z, int64_t[::1] m_z, int64_t[::1] n_z, int[:, ::1] n_w_z, double[::1] gl_base,
+                     double[:, ::1] p_cache, int64_t[::1] doc_version, int64_t version_start, int batch_size,
+                     double alpha, double beta, int K, int V, int D, const double[::1] rand_uniforms):
+    '''
+    Run one Gibbs sampling pass over the flattened corpus, updating the cluster state in place.
+    See gsdmm.mgp_array._gibbs_iter for the parameters.
+    :return: int
+        number of documents that changed cluster
+    '''
+    cdef Py_ssize_t i, j, k, w, start, end
+    cdef int z_old, z_new, total_transfers = 0
+    cdef int64_t doc_size, version, batch, snap_version = version_start, max_doc_size = 0
+    cdef double lN1, lD2, p_max, p_total, u
+    cdef double[::1] p
+    cdef bint cached = doc_version.shape[0] > 0
+
+    # state of the lazy variant, see gsdmm.mgp_array._gibbs_iter
+    if batch_size > 0:
+        for i in range(D):
+            max_doc_size = max(max_doc_size, doc_offsets[i + 1] - doc_offsets[i])
+    cdef double[::1] n_z_snap = np.empty(K)
+    cdef double[::1] gl_snap = np.empty(K)
+    cdef double[:, ::1] lD2_tab = np.empty((max_doc_size + 1, K))
+    cdef int64_t[::1] lD2_batch = np.full(max_doc_size + 1, -1, dtype=np.int64)
+
+    for i in range(D):
+        start = doc_offsets[i]
+        end = doc_offsets[i + 1]
+        doc_size = end - start
+        p = p_cache[i if cached else 0]
+
+        if batch_size > 0 and i % batch_size == 0:
+            snap_version = version_start + total_transfers
+            for k in range(K):
+                n_z_snap[k] = n_z[k] + V * beta
+                gl_snap[k] = lgamma(n_z_snap[k])
+
+        # remove the doc from it's current cluster
+        z_old = d_z[i]
+        m_z[z_old] -= 1
+        n_z[z_old] -= doc_size
+        for j in range(start, end):
+            n_w_z[words[j], z_old] -= counts[j]
+        if batch_size == 0:
+            gl_base[z_old] = lgamma(n_z[z_old] + V * beta)
+
+        # reuse the cached distribution if no doc has moved since this doc was last scored
+        version = version_start + total_transfers
+        if not cached or doc_version[i] != version:
+            if cached:
+                doc_version[i] = snap_version if batch_size > 0 else version
+
+            # score the doc in log space
+            if batch_size > 0:
+                batch = i // batch_size
+                if lD2_batch[doc_size] != batch:
+                    lD2_batch[doc_size] = batch
+                    for k in range(K):
+                        lD2_tab[doc_size, k] = lgamma(n_z_snap[k] + doc_size) - gl_snap[k]
+                for k in range(K):
+                    p[k] = log(m_z[k] + alpha) - lD2_tab[doc_size, k]
+            else:
+                for k in range(K):
+                    lN1 = log(m_z[k] + alpha)
+                    lD2 = lgamma(n_z[k] + V * beta + doc_size) - gl_base[k]
+                    p[k] = lN1 - lD2
+            for j in range(start, end):
+                w = words[j]
+                for k in range(K):
+                    p[k] += log(n_w_z[w, k] + beta)
+
+            # turn the scores into cumulative weights
+            p_max = p[0]
+            for k in range(1, K):
+                if p[k] > p_max:
+                    p_max = p[k]
+            p_total = 0.0
+            for k in range(K):
+                p_total += exp(p[k] - p_max)
+                p[k] = p_total
+
+        # draw sample from the distribution via its cumulative sum
+        u = rand_uniforms[i] * p[K - 1]
+        z_new = K - 1
+        for k in range(K):
+            if u < p[k]:
+                z_new = k
+                break
+
+        # transfer doc to the new cluster
+        if z_new != z_old:
+            total_transfers += 1
+
+        d_z[i] = z_new
+        m_z[z_new] += 1
+        n_z[z_new] += doc_size
+        for j in range(start, end):
+            n_w_z[words[j], z_new] += counts[j]
+        if batch_size == 0:
+            gl_base[z_new] = lgamma(n_z[z_new] + V * beta)
+
+    return total_transfers
@@ -18,6 +18,7 @@ from six import PY3, iteritems, iterkeys, itervalues, string_types
 from six.moves import zip, range
 
 from .utils import utils
+from .utils.utils import to_unicode as _to_unicode
 
 if sys.version_info[0] >= 3:
     unicode = str
@@ -523,16 +524,19 @@ class Dictionary():
         """
         logger.info("saving dictionary mapping to %s", fname)
         with utils.open(fname, 'wb') as fout:
-            numdocs_line = "%d\n" % self.num_docs
-            fout.write(utils.to_utf8(numdocs_line))
             if sort_by_word:
-                for token, tokenid in sorted(iteritems(self.token2id)):
-                    line = "%i\t%s\t%i\n" % (tokenid, token, self.dfs.get(tokenid, 0))
-                    fout.write(utils.to_utf8(line))
+                lines = ("%i\t%s\t%i\n" % (tokenid, token, self.dfs.get(tokenid, 0))
+                         for token, tokenid in sorted(iteritems(self.token2id)))
             else:
-                for tokenid, freq in sorted(iteritems(self.dfs), key=lambda item: -item[1]):
-                    line = "%i\t%s\t%i\n" % (tokenid, self[tokenid], freq)
-                    fout.write(utils.to_utf8(line))
+                lines = ("%i\t%s\t%i\n" % (tokenid, self[tokenid], freq)
+                         for tokenid, freq in sorted(iteritems(self.dfs), key=lambda item: -item[1]))
+            lines = itertools.chain(["%d\n" % self.num_docs], lines)
+            # encode and write a bounded number of lines at a time, not the whole vocabulary at once
+            while True:
+                chunk = list(itertools.islice(lines, 10000))
+                if not chunk:
+                    break
+                fout.writelines(utils.any2utf8_batch(chunk))
 
     def merge_with(self, other):
         """Merge another dictionary into this dictionary, mapping the same tokens to the same ids
@@ -677,7 +681,7 @@ class Dictionary():
         result = Dictionary()
         with utils.open(fname, 'rb') as f:
             for lineno, line in enumerate(f):
-                line = utils.to_unicode(line)
+                line = _to_unicode(line)
                 if lineno == 0:
                     if line.strip().isdigit():
                         # Older versions of save_as_text may not write num_docs on first line.
@@ -750,7 +754,7 @@ class Dictionary():
             result.token2id = {unicode(i): i for i in range(max_id + 1)}
         else:
             # id=>word mapping given: simply copy it
-            result.token2id = {utils.to_unicode(token): idx for idx, token in iteritems(id2word)}
+            result.token2id = {_to_unicode(token): idx for idx, token in iteritems(id2word)}
         for idx in itervalues(result.token2id):
             # make sure all token ids have a valid `dfs` entry
             result.dfs[idx] = result.dfs.get(idx, 0)
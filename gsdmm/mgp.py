@@ -1,7 +1,7 @@
-from numpy.random import multinomial
 from numpy import log, exp
 from numpy import argmax
 import numpy as np
+from scipy.special import gammaln
 
 class MovieGroupProcess:
     def __init__(self, K=8, alpha=0.1, beta=0.1, n_iters=30):
@@ -38,8 +38,8 @@ class MovieGroupProcess:
         # slots for computed variables
         self.number_docs = None
         self.vocab_size = None
-        self.cluster_doc_count = [0 for _ in range(K)]
-        self.cluster_word_count = [0 for _ in range(K)]
+        self.cluster_doc_count = np.zeros(K, dtype=np.int64)
+        self.cluster_word_count = np.zeros(K, dtype=np.int64)
         self.cluster_word_distribution = [{} for i in range(K)]
 
     @staticmethod
@@ -69,11 +69,13 @@ class MovieGroupProcess:
         '''
         Sample with probability vector p from a multinomial distribution
         :param p: list
-            List of probabilities representing probability vector for the multinomial distribution
+            List of non-negative weights proportional to the probability vector for the multinomial distribution
         :return: int
             index of randomly selected output
         '''
-        return [i for i, entry in enumerate(multinomial(1, p)) if entry != 0][0]
+        c = np.cumsum(p)
+        # clamp in case rounding puts the draw at the very end of the distribution
+        return min(int(np.searchsorted(c, np.random.random() * c[-1], side='right')), len(c) - 1)
 
     def fit(self, docs, vocab_size):
         '''
@@ -81,7 +83,7 @@ class MovieGroupProcess:
         :param docs: list of list
             list of lists containing the unique token set of each document
         :param V: total vocabulary size for each document
-        :return: list of length len(doc)
+        :return: np.ndarray of length len(doc)
             cluster label for each document
         '''
         alpha, beta, K, n_iters, V = self.alpha, self.beta, self.K, self.n_iters, vocab_size
@@ -93,7 +95,7 @@ class MovieGroupProcess:
         # unpack to easy var names
         m_z, n_z, n_z_w = self.cluster_doc_count, self.cluster_word_count, self.cluster_word_distribution
         cluster_count = K
-        d_z = [None for i in range(len(docs))]
+        d_z = np.full(D, -1, dtype=np.int32)
 
         # initialize the clusters
         for i, doc in enumerate(docs):
@@ -144,7 +146,7 @@ class MovieGroupProcess:
                         n_z_w[z_new][word] = 0
                     n_z_w[z_new][word] += 1
 
-            cluster_count_new = sum([1 for v in m_z if v > 0])
+            cluster_count_new = int((m_z > 0).sum())
             print("In stage %d: transferred %d clusters with %d clusters populated" % (
             _iter, total_transfers, cluster_count_new))
             if total_transfers == 0 and cluster_count_new == cluster_count and _iter>25:
@@ -162,37 +164,34 @@ class MovieGroupProcess:
         http://dbgroup.cs.tsinghua.edu.cn/wangjy/papers/KDD14-GSDMM.pdf
 
         :param doc: list[str]: The doc token stream
-        :return: list[float]: A length K probability vector where each component represents
-                              the probability of the document appearing in a particular cluster
+        :return: np.ndarray[float]: A length K vector where each component is proportional to
+                                    the probability of the document appearing in a particular cluster,
+                                    scaled so the largest component is 1
         '''
         alpha, beta, K, V, D = self.alpha, self.beta, self.K, self.vocab_size, self.number_docs
         m_z, n_z, n_z_w = self.cluster_doc_count, self.cluster_word_count, self.cluster_word_distribution
 
-        p = [0 for _ in range(K)]
+        lp = np.zeros(K)
 
         #  We break the formula into the following pieces
         #  p = N1*N2/(D1*D2) = exp(lN1 - lD1 + lN2 - lD2)
+        #  the log scores are shifted by their max before exp, so long docs don't underflow to all zeros
         #  lN1 = log(m_z[z] + alpha)
         #  lN2 = log(D - 1 + K*alpha)
         #  lN2 = log(product(n_z_w[w] + beta)) = sum(log(n_z_w[w] + beta))
         #  lD2 = log(product(n_z[d] + V*beta + i -1)) = sum(log(n_z[d] + V*beta + i -1))
+        #      = gammaln(n_z[d] + V*beta + doc_size) - gammaln(n_z[d] + V*beta)
 
         lD1 = log(D - 1 + K * alpha)
         doc_size = len(doc)
         for label in range(K):
             lN1 = log(m_z[label] + alpha)
             lN2 = 0
-            lD2 = 0
             for word in doc:
                 lN2 += log(n_z_w[label].get(word, 0) + beta)
-            for j in range(1, doc_size +1):
-                lD2 += log(n_z[label] + V * beta + j - 1)
-            p[label] = exp(lN1 - lD1 + lN2 - lD2)
-
-        # normalize the probability vector
-        pnorm = sum(p)
-        pnorm = pnorm if pnorm>0 else 1
-        return [pp/pnorm for pp in p]
+            lD2 = gammaln(n_z[label] + V * beta + doc_size) - gammaln(n_z[label] + V * beta)
+            lp[label] = lN1 - lD1 + lN2 - lD2
+        return exp(lp - lp.max())
 
     def choose_best_label(self, doc):
         '''
@@ -201,7 +200,9 @@ class MovieGroupProcess:
         :return:
         '''
         p = self.score(doc)
-        return argmax(p),max(p)
+        pnorm = p.sum()
+        pnorm = pnorm if pnorm > 0 else 1
+        return argmax(p), p.max() / pnorm
 
     def top_words(self, values=5, join_tok=' '):
         doc_count = np.array(self.cluster_doc_count)
@@ -1,9 +1,189 @@
+import math
+import multiprocessing
 import os
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 
 import numpy as np
+from scipy.special import gammaln
 from .dictionary import Dictionary
 
+try:
+    from numba import njit
+    _HAS_NUMBA = True
+except ImportError:
+    # without numba the kernels below run as plain python, build gsdmm/_gibbs.pyx to keep fit fast
+    _HAS_NUMBA = False
+
+    def njit(*args, **kwargs):
+        return lambda f: f
+
+try:
+    from ._gibbs import gibbs_iter as _gibbs_iter_compiled
+except ImportError:
+    _gibbs_iter_compiled = None
+
+
+@njit(cache=True, fastmath=True)
+def _gibbs_iter(doc_offsets, words, counts, d_z, m_z, n_z, n_w_z, gl_base, p_cache, doc_version, version_start,
+                batch_size, alpha, beta, K, V, D, rand_uniforms):
+    '''
+    Run one Gibbs sampling pass over the flattened corpus, updating the cluster state in place.
+    Document i spans words[doc_offsets[i]:doc_offsets[i + 1]] (and the matching counts).
+    :param n_w_z: (V, K) word counts per cluster, i.e. the transposed cluster_word_distribution, so that
+        the counts of one word over all clusters are contiguous
+    :param gl_base: array of lgamma(n_z + V * beta), kept in sync with n_z for the clusters a doc leaves and joins
+    :param p_cache: (D, K) cumulative sampling weights of each doc from the last time it was scored, or (1, K)
+        scratch space for the weights when the cache is off
+    :param doc_version: number of transfers made before each doc was last scored, -1 if never scored. Empty
+        when the cache is off
+    :param version_start: number of transfers made in the previous passes
+    :param batch_size: 0 for the exact sampler. Otherwise the score denominator is computed from a snapshot
+        of n_z taken every batch_size docs, and shared by the docs of the same length in a batch
+    :param rand_uniforms: array of D uniform draws on [0, 1), drawn with numpy so np.random.seed applies
+    :return: int
+        number of documents that changed cluster
+    '''
+    total_transfers = 0
+    snap_version = version_start
+    cached = doc_version.shape[0] > 0
+
+    # state of the lazy variant: snapshot of n_z + V*beta and its lgamma, and lD2 per doc length
+    # together with the batch it was computed for
+    max_doc_size = 0
+    if batch_size > 0:
+        for i in range(D):
+            max_doc_size = max(max_doc_size, doc_offsets[i + 1] - doc_offsets[i])
+    n_z_snap = np.empty(K)
+    gl_snap = np.empty(K)
+    lD2_tab = np.empty((max_doc_size + 1, K))
+    lD2_batch = np.full(max_doc_size + 1, -1)
+
+    for i in range(D):
+        start, end = doc_offsets[i], doc_offsets[i + 1]
+        doc_size = end - start
+        p = p_cache[i if cached else 0]
+
+        if batch_size > 0 and i % batch_size == 0:
+            snap_version = version_start + total_transfers
+            for k in range(K):
+                n_z_snap[k] = n_z[k] + V * beta
+                gl_snap[k] = math.lgamma(n_z_snap[k])
+
+        # remove the doc from it's current cluster
+        z_old = d_z[i]
+        m_z[z_old] -= 1
+        n_z[z_old] -= doc_size
+        for j in range(start, end):
+            n_w_z[words[j], z_old] -= counts[j]
+        if batch_size == 0:
+            gl_base[z_old] = math.lgamma(n_z[z_old] + V * beta)
+
+        # a doc that stays put leaves the counts as they were, so if no doc has moved since this
+        # doc was last scored (or since the snapshot it was scored with) its distribution is
+        # unchanged and the cached one can be reused
+        version = version_start + total_transfers
+        if not cached or doc_version[i] != version:
+            if cached:
+                doc_version[i] = snap_version if batch_size > 0 else version
+
+            # score the doc in log space, see MovieGroupProcess.score. lD1 is the same
+            # for every cluster, so it cancels out in the sampling below
+            if batch_size > 0:
+                batch = i // batch_size
+                if lD2_batch[doc_size] != batch:
+                    lD2_batch[doc_size] = batch
+                    for k in range(K):
+                        lD2_tab[doc_size, k] = math.lgamma(n_z_snap[k] + doc_size) - gl_snap[k]
+                for k in range(K):
+                    p[k] = np.log(m_z[k] + alpha) - lD2_tab[doc_size, k]
+            else:
+                for k in range(K):
+                    lN1 = np.log(m_z[k] + alpha)
+                    lD2 = math.lgamma(n_z[k] + V * beta + doc_size) - gl_base[k]
+                    p[k] = lN1 - lD2
+            for j in range(start, end):
+                w = words[j]
+                for k in range(K):
+                    p[k] += np.log(n_w_z[w, k] + beta)
+
+            # turn the scores into cumulative weights
+            p_max = p[0]
+            for k in range(1, K):
+                if p[k] > p_max:
+                    p_max = p[k]
+            p_total = 0.0
+            for k in range(K):
+                p_total += np.exp(p[k] - p_max)
+                p[k] = p_total
+
+        # draw sample from the distribution via its cumulative sum
+        u = rand_uniforms[i] * p[K - 1]
+        z_new = K - 1
+        for k in range(K):
+            if u < p[k]:
+                z_new = k
+                break
+
+        # transfer doc to the new cluster
+        if z_new != z_old:
+            total_transfers += 1
+
+        d_z[i] = z_new
+        m_z[z_new] += 1
+        n_z[z_new] += doc_size
+        for j in range(start, end):
+            n_w_z[words[j], z_new] += counts[j]
+        if batch_size == 0:
+            gl_base[z_new] = math.lgamma(n_z[z_new] + V * beta)
+
+    return total_transfers
+
+
+@njit(cache=True, fastmath=True)
+def _log_sum(n_z_w, idx, beta, out):
+    '''
+    Sum log(n_z_w[k, w] + beta) over the words w in idx for every cluster k into out, in one pass
+    and without materializing the (K, len(idx)) gather n_z_w[:, idx].
+    The logs are taken in float32, which is plenty for scoring, and accumulated in float64.
+    '''
+    K = n_z_w.shape[0]
+    beta32 = np.float32(beta)
+    out[:] = 0.0
+    for w in idx:
+        for k in range(K):
+            out[k] += np.log(np.float32(n_z_w[k, w]) + beta32)
+    return out
+
+
+def _log_sum_numpy(n_z_w, idx, beta, out):
+    '''
+    Same as _log_sum with numpy operations on the (K, len(idx)) gather, used when numba is not installed
+    '''
+    logs = n_z_w[:, idx].astype(np.float32)
+    logs += np.float32(beta)
+    np.log(logs, out=logs)
+    return logs.sum(axis=1, dtype=np.float64, out=out)
+
+
+if not _HAS_NUMBA:
+    _log_sum = _log_sum_numpy
+
+
+# model and scoring work arrays of the prediction worker processes, set once per worker by _init_predict_worker
+_predict_model = None
+_predict_scratch = None
+
+
+def _init_predict_worker(model):
+    global _predict_model, _predict_scratch
+    _predict_model = model
+    _predict_scratch = np.empty((3, model.K))
+
+
+def _predict_worker(doc_corpus):
+    return _predict_model._score_one(doc_corpus, _predict_scratch)
+
 
 class MovieGroupProcess:
     def __init__(self, K=8, alpha=0.1, beta=0.1, n_iters=30):
@@ -40,8 +220,8 @@ class MovieGroupProcess:
         # slots for computed variables
         self.number_docs = None
         self.vocab_size = None
-        self.cluster_doc_count = np.array([0 for _ in range(K)])
-        self.cluster_word_count = np.array([0 for _ in range(K)])
+        self.cluster_doc_count = np.zeros(K, dtype=np.int64)
+        self.cluster_word_count = np.zeros(K, dtype=np.int64)
         self.cluster_word_distribution = [{} for i in range(K)]
 
     @staticmethod
@@ -74,36 +254,45 @@ class MovieGroupProcess:
         :return:
         '''
         if os.path.isdir(folder_path):
-            print(f'Folder {folder_path} already exists, not overwriting it. Exiting!')
+            raise FileExistsError(f'Folder {folder_path} already exists, not overwriting it')
 
         os.mkdir(folder_path)
 
-        with open(Path(folder_path, 'gsdmm.npy'), 'wb') as f:
-            np.save(f, self.K)
-            np.save(f, self.alpha)
-            np.save(f, self.beta)
-            np.save(f, self.cluster_doc_count)
-            np.save(f, self.cluster_word_count)
-            np.save(f, self.cluster_word_distribution)
+        np.savez(Path(folder_path, 'gsdmm.npz'), K=self.K, alpha=self.alpha, beta=self.beta,
+                 cluster_doc_count=self.cluster_doc_count, cluster_word_count=self.cluster_word_count)
+        # the (K, V) matrix goes to its own .npy file so load can memory map it
+        np.save(Path(folder_path, 'cluster_word_distribution.npy'), self.cluster_word_distribution)
 
         self.dictionary.save_as_text(Path(folder_path, 'dictionary.npy'))
 
     @staticmethod
-    def load(folder_path):
+    def load(folder_path, mmap_mode='r'):
         '''
           Loads MovieGroupProcess model and dictionary
            :param folder_path:
+           :param mmap_mode: mmap_mode passed to np.load for cluster_word_distribution, None reads it into memory
            :return:
            MovieGroupProcess class instance with correct weights
            '''
 
-        with open(Path(folder_path, 'gsdmm.npy'), 'rb') as f:
-            K = np.load(f)
-            alpha = np.load(f)
-            beta = np.load(f)
-            cluster_doc_count = np.load(f)
-            cluster_word_count = np.load(f)
-            cluster_word_distribution = np.load(f)
+        if os.path.isfile(Path(folder_path, 'gsdmm.npz')):
+            with np.load(Path(folder_path, 'gsdmm.npz')) as data:
+                K = int(data['K'])
+                alpha = float(data['alpha'])
+                beta = float(data['beta'])
+                cluster_doc_count = data['cluster_doc_count']
+                cluster_word_count = data['cluster_word_count']
+            cluster_word_distribution = np.load(Path(folder_path, 'cluster_word_distribution.npy'),
+                                                mmap_mode=mmap_mode)
+        else:
+            # models saved before the npz format
+            with open(Path(folder_path, 'gsdmm.npy'), 'rb') as f:
+                K = np.load(f)
+                alpha = np.load(f)
+                beta = np.load(f)
+                cluster_doc_count = np.load(f)
+                cluster_word_count = np.load(f)
+                cluster_word_distribution = np.load(f)
 
         dictionary = Dictionary.load_from_text(Path(folder_path, 'dictionary.npy'))
         mgp = MovieGroupProcess.from_data(K, alpha, beta, dictionary, cluster_doc_count, cluster_word_count,
@@ -115,26 +304,50 @@ class MovieGroupProcess:
         '''
         Sample with probability vector p from a multinomial distribution
         :param p: list
-            List of probabilities representing probability vector for the multinomial distribution
+            List of non-negative weights proportional to the probability vector for the multinomial distribution
         :return: int
             index of randomly selected output
         '''
-        return [i for i, entry in enumerate(np.random.multinomial(1, p)) if entry != 0][0]
+        c = np.cumsum(p)
+        # clamp in case rounding puts the draw at the very end of the distribution
+        return min(int(np.searchsorted(c, np.random.random() * c[-1], side='right')), len(c) - 1)
 
     def create_dictionary(self, docs_toks):
         self.dictionary = Dictionary(docs_toks)
-        self.corpus = [self.dictionary.doc2bow(text) for text in docs_toks]
         self.vocab_size = len(self.dictionary)
 
-    def fit(self, docs):
+        # bow of each doc as (token ids, counts) arrays, built straight from token2id instead of a
+        # second doc2bow pass, so fit doesn't unpack bow tuples every pass
+        t2i = self.dictionary.token2id
+        ids = [np.fromiter((t2i[w] for w in doc if w in t2i), dtype=np.intp) for doc in docs_toks]
+        self.corpus = [np.unique(doc_ids, return_counts=True) for doc_ids in ids]
+        self._doc_idx = [idx for idx, _ in self.corpus]
+        self._doc_cnt = [cnt.astype(np.int32) for _, cnt in self.corpus]
+        self._doc_size = np.array([len(idx) for idx in self._doc_idx], dtype=np.int32)
+
+    def fit(self, docs, variant='standard', batch_size=16, cache_scores=False):
         '''
         Cluster the input documents
         :param docs: list of list
             list of lists containing the unique token set of each document
-        :param V: total vocabulary size for each document
-        :return: list of length len(doc)
+        :param variant: 'standard' or 'collapsed_lazy'
+            'collapsed_lazy' refreshes the cluster sizes in the score denominator only every batch_size docs
+            and reuses the denominator for docs of the same length within a batch. Fewer lgamma evaluations
+            for slightly staler counts while sampling
+        :param batch_size: int
+            number of docs between denominator refreshes for the 'collapsed_lazy' variant
+        :param cache_scores: bool
+            keep the last sampling weights of every doc (a D x K float64 array) and reuse them in passes
+            where no doc has changed cluster since the doc was scored
+        :return: np.ndarray of length len(doc)
             cluster label for each document
         '''
+        if variant == 'standard':
+            batch_size = 0
+        elif variant != 'collapsed_lazy':
+            raise ValueError(f"variant must be 'standard' or 'collapsed_lazy', got {variant!r}")
+        elif batch_size < 1:
+            raise ValueError(f'batch_size must be positive, got {batch_size}')
 
         self.create_dictionary(docs)
 
@@ -143,60 +356,64 @@ class MovieGroupProcess:
         D = len(self.corpus)
         self.number_docs = D
 
-        self.cluster_word_distribution = np.zeros((K, self.vocab_size), dtype=int)
+        self.cluster_doc_count = np.zeros(K, dtype=np.int64)
+        self.cluster_word_count = np.zeros(K, dtype=np.int64)
+        # per cluster word counts never come near 2**31, int32 halves the memory of the count matrix.
+        # It is kept word major, (V, K), so a doc's counts over all clusters are read row by row
+        n_w_z = np.zeros((self.vocab_size, K), dtype=np.int32)
 
         # unpack to easy var names
-        m_z, n_z, n_z_w = self.cluster_doc_count, self.cluster_word_count, self.cluster_word_distribution
+        m_z, n_z = self.cluster_doc_count, self.cluster_word_count
+        doc_idx, doc_cnt, doc_size = self._doc_idx, self._doc_cnt, self._doc_size
         cluster_count = K
-        d_z = [None for i in range(len(self.corpus))]
+        d_z = np.empty(D, dtype=np.int32)
+
+        # flatten the corpus, doc i spans doc_word_idx[doc_offsets[i]:doc_offsets[i + 1]]
+        doc_offsets = np.zeros(D + 1, dtype=np.int64)
+        doc_offsets[1:] = np.cumsum(doc_size)
+        doc_word_idx = np.concatenate(doc_idx).astype(np.int32)
+        doc_word_cnt = np.concatenate(doc_cnt)
 
         # initialize the clusters
-        for i, doc in enumerate(self.corpus):
+        for i in range(D):
             # choose a random  initial cluster for the doc
             z = self._sample([1.0 / K for _ in range(K)])
             d_z[i] = z
             m_z[z] += 1
-            n_z[z] += len(doc)
+            n_z[z] += doc_size[i]
+            n_w_z[doc_idx[i], z] += doc_cnt[i]
 
-            idx, cnt = zip(*doc)
-            n_z_w[z, idx] += cnt
+        # cache of the cluster dependent part of the score denominator, see score()
+        gl_base = gammaln(n_z + V * beta)
 
-        for _iter in range(n_iters):
-            total_transfers = 0
+        # last sampling weights of each doc, reused by the kernel while no doc has changed cluster.
+        # Without the cache the kernel scores every doc into a single scratch row
+        if cache_scores:
+            p_cache = np.empty((D, K))
+            doc_version = np.full(D, -1, dtype=np.int64)
+        else:
+            p_cache = np.empty((1, K))
+            doc_version = np.empty(0, dtype=np.int64)
+        version = 0
 
-            for i, doc in enumerate(self.corpus):
+        # prefer the ahead of time compiled kernel when the extension is built
+        gibbs_iter = _gibbs_iter_compiled or _gibbs_iter
 
-                # remove the doc from it's current cluster
-                z_old = d_z[i]
-
-                m_z[z_old] -= 1
-                n_z[z_old] -= len(doc)
-
-                idx, cnt = zip(*doc)
-                n_z_w[z_old, idx] -= cnt
-
-                # draw sample from distribution to find new cluster
-                p = self.score(doc)
-                z_new = self._sample(p)
-
-                # transfer doc to the new cluster
-                if z_new != z_old:
-                    total_transfers += 1
-
-                d_z[i] = z_new
-                m_z[z_new] += 1
-                n_z[z_new] += len(doc)
-
-                n_z_w[z_new, idx] += cnt
+        for _iter in range(n_iters):
+            total_transfers = gibbs_iter(doc_offsets, doc_word_idx, doc_word_cnt, d_z, m_z, n_z, n_w_z, gl_base,
+                                         p_cache, doc_version, version, batch_size, alpha, beta, K, V, D,
+                                         np.random.random(D))
+            version += total_transfers
 
-            cluster_count_new = sum([1 for v in m_z if v > 0])
+            cluster_count_new = int((m_z > 0).sum())
             print("In stage %d: transferred %d clusters with %d clusters populated" % (
                 _iter, total_transfers, cluster_count_new))
             if total_transfers == 0 and cluster_count_new == cluster_count and _iter > 25:
                 print("Converged.  Breaking out.")
                 break
             cluster_count = cluster_count_new
-        self.cluster_word_distribution = n_z_w
+        # (K, V) view of the counts, no copy
+        self.cluster_word_distribution = n_w_z.T
         return d_z
 
     def score(self, doc):
@@ -207,34 +424,52 @@ class MovieGroupProcess:
         http://dbgroup.cs.tsinghua.edu.cn/wangjy/papers/KDD14-GSDMM.pdf
 
         :param doc: list[str]: The doc token stream
-        :return: list[float]: A length K probability vector where each component represents
-                              the probability of the document appearing in a particular cluster
+        :return: np.ndarray[float]: A length K vector where each component is proportional to
+                                    the probability of the document appearing in a particular cluster
+        '''
+        return self._score(doc)
+
+    def _score(self, doc, scratch=None):
+        '''
+        Same as score. With scratch, a (3, K) work array owned by the caller, nothing is allocated and the
+        returned vector is scratch[2], overwritten by the next call given the same scratch
         '''
         alpha, beta, K, V, D = self.alpha, self.beta, self.K, self.vocab_size, self.number_docs
         m_z, n_z, n_z_w = self.cluster_doc_count, self.cluster_word_count, self.cluster_word_distribution
 
-        p = [0 for _ in range(K)]
-
         #  We break the formula into the following pieces
         #  p = N1*N2/(D1*D2) = exp(lN1 - lD1 + lN2 - lD2)
+        #  the log scores are shifted by their max before exp, so long docs don't underflow to all zeros
         #  lN1 = log(m_z[z] + alpha)
         #  lN2 = log(D - 1 + K*alpha)
         #  lN2 = log(product(n_z_w[w] + beta)) = sum(log(n_z_w[w] + beta))
         #  lD2 = log(product(n_z[d] + V*beta + i -1)) = sum(log(n_z[d] + V*beta + i -1))
+        #      = gammaln(n_z[d] + V*beta + doc_size) - gammaln(n_z[d] + V*beta)
 
         lD1 = np.log(D - 1 + K * alpha)
         doc_size = len(doc)
-        idx, cnt = zip(*doc)
+        idx = np.array([w for w, _ in doc], dtype=np.intp)
 
-        lN1 = np.log(m_z + alpha)
-        lN2 = np.log(n_z_w[:, idx] + beta).sum(axis=1)
-        lD2 = np.log(n_z.reshape(-1, 1) + V * beta + np.array(range(1, doc_size + 1)) - 1).sum(axis=1)
-        p = np.exp(lN1 - lD1 + lN2 - lD2)
+        lN2, lD2, p = scratch if scratch is not None else (np.empty(K), np.empty(K), np.empty(K))
 
-        # normalize the probability vector
-        pnorm = sum(p)
-        pnorm = pnorm if pnorm > 0 else 1
-        return [pp / pnorm for pp in p]
+        _log_sum(n_z_w, idx, beta, lN2)
+
+        # lD2, with p holding n_z + V*beta (+ doc_size) meanwhile
+        np.add(n_z, V * beta, out=p)
+        gammaln(p, out=lD2)
+        p += doc_size
+        gammaln(p, out=p)
+        np.subtract(p, lD2, out=lD2)
+
+        # p = exp(lN1 - lD1 + lN2 - lD2)
+        np.add(m_z, alpha, out=p)
+        np.log(p, out=p)
+        p -= lD1
+        p += lN2
+        p -= lD2
+        p -= p.max()
+        np.exp(p, out=p)
+        return p
 
     def choose_best_label(self, doc):
         '''
@@ -244,19 +479,58 @@ class MovieGroupProcess:
         '''
 
         doc_corpus = self.dictionary.doc2bow(doc)
-        p = self.score(doc_corpus)
-        return np.argmax(p), max(p)
+        return self._score_one(doc_corpus)
+
+    def _score_one(self, doc_corpus, scratch=None):
+        p = self._score(doc_corpus, scratch)
+        pnorm = p.sum()
+        pnorm = pnorm if pnorm > 0 else 1
+        return np.argmax(p), p.max() / pnorm
+
+    def predict(self, docs, n_jobs=-1):
+        '''
+        Choose the highest probability label for each input document, scoring the documents in parallel
+        :param docs: list of list
+            list of lists containing the tokens of each document
+        :param n_jobs: int
+            number of worker processes, -1 uses all cpus and 1 scores in the current process
+        :return: tuple(np.ndarray, np.ndarray)
+            best label and its probability for each document
+        '''
+        if n_jobs == -1:
+            n_jobs = os.cpu_count()
+        docs_corpus = [self.dictionary.doc2bow(doc) for doc in docs]
+
+        if n_jobs == 1:
+            scratch = np.empty((3, self.K))
+            results = [self._score_one(doc_corpus, scratch) for doc_corpus in docs_corpus]
+        else:
+            # send only the fitted weights to the workers, not the training corpus
+            model = MovieGroupProcess.from_data(self.K, self.alpha, self.beta, self.dictionary,
+                                                self.cluster_doc_count, self.cluster_word_count,
+                                                self.cluster_word_distribution)
+            # don't fork, the process may be running threads (jax, BLAS) that the children would inherit mid-state
+            start_method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+            with ProcessPoolExecutor(max_workers=n_jobs, mp_context=multiprocessing.get_context(start_method),
+                                     initializer=_init_predict_worker, initargs=(model,)) as executor:
+                results = list(executor.map(_predict_worker, docs_corpus,
+                                            chunksize=max(1, len(docs_corpus) // (8 * n_jobs))))
+
+        labels = np.array([label for label, _ in results], dtype=np.int64)
+        probs = np.array([prob for _, prob in results], dtype=float)
+        return labels, probs
 
     def top_words(self, n_toks=5, join_tok=' '):
         doc_count = np.array(self.cluster_doc_count)
         n_topics_with_docs = sum(doc_count > 0)  # dont need topics where no docs
         top_index = doc_count.argsort()[-n_topics_with_docs:][::-1]
         topic_words = {}
-        top_cluster_tok_idx = np.argsort(-self.cluster_word_distribution)[:, :n_toks]
+        # only the n_toks largest counts per cluster are needed, partition instead of sorting all V
+        n_toks = min(n_toks, self.cluster_word_distribution.shape[1])
+        top_cluster_tok_idx = np.argpartition(-self.cluster_word_distribution, n_toks - 1, axis=1)[:, :n_toks]
 
         for cluster in top_index:
-            words_ = ''
-            for idx in top_cluster_tok_idx[cluster]:
-                words_ = f'{words_}{join_tok}{self.dictionary[idx]}'
-            topic_words[cluster] = words_
+            part = top_cluster_tok_idx[cluster]
+            top = part[np.argsort(-self.cluster_word_distribution[cluster, part], kind='stable')]
+            topic_words[cluster] = join_tok.join(self.dictionary[idx] for idx in top)
         return topic_words
@@ -0,0 +1,125 @@
+import jax
+import jax.numpy as jnp
+import numpy as np
+
+from .mgp_array import MovieGroupProcess as MovieGroupProcessArray
+
+
+@jax.jit
+def _score_logits(n_w_z, n_z, m_z, idx, cnt, doc_size, alpha, beta, V):
+    '''
+    Log of the unnormalized cluster probabilities of one padded doc, see MovieGroupProcessArray.score.
+    Padding positions have cnt == 0 and are left out of the word term.
+    '''
+    lN1 = jnp.log(m_z + alpha)
+    lN2 = jnp.where((cnt > 0)[:, None], jnp.log(n_w_z[idx] + beta), 0.0).sum(axis=0)
+    # lD2 = sum(log(n_z + V*beta + j)) over j < doc_size, summed term by term because the difference of
+    # gammaln(n_z + V*beta + doc_size) and gammaln(n_z + V*beta) loses its precision in float32
+    j = jnp.arange(idx.shape[0])
+    lD2 = jnp.where((j < doc_size)[:, None], jnp.log(n_z + V * beta + j[:, None]), 0.0).sum(axis=0)
+    return lN1 + lN2 - lD2
+
+
+@jax.jit
+def _gibbs_pass(d_z, m_z, n_z, n_w_z, doc_idx, doc_cnt, doc_size, key, alpha, beta, V):
+    '''
+    One Gibbs sampling pass over the padded corpus, as a scan over the docs
+    :return: updated (d_z, m_z, n_z, n_w_z) and the number of docs that changed cluster
+    '''
+    def step(carry, x):
+        d_z, m_z, n_z, n_w_z, transfers = carry
+        i, doc_key = x
+        idx, cnt, size = doc_idx[i], doc_cnt[i], doc_size[i]
+
+        # remove the doc from it's current cluster
+        z_old = d_z[i]
+        m_z = m_z.at[z_old].add(-1)
+        n_z = n_z.at[z_old].add(-size)
+        n_w_z = n_w_z.at[idx, z_old].add(-cnt)
+
+        # draw sample from distribution to find new cluster
+        z_new = jax.random.categorical(doc_key, _score_logits(n_w_z, n_z, m_z, idx, cnt, size, alpha, beta, V))
+
+        # transfer doc to the new cluster
+        d_z = d_z.at[i].set(z_new)
+        m_z = m_z.at[z_new].add(1)
+        n_z = n_z.at[z_new].add(size)
+        n_w_z = n_w_z.at[idx, z_new].add(cnt)
+        return (d_z, m_z, n_z, n_w_z, transfers + (z_new != z_old)), None
+
+    D = doc_idx.shape[0]
+    keys = jax.random.split(key, D)
+    carry, _ = jax.lax.scan(step, (d_z, m_z, n_z, n_w_z, 0), (jnp.arange(D), keys))
+    return carry
+
+
+class MovieGroupProcess(MovieGroupProcessArray):
+    '''
+    MovieGroupProcess whose Gibbs sampler runs as a jax.lax.scan compiled by XLA, on CPU or GPU.
+    Scoring, prediction, top words and saving are inherited from the array version.
+    '''
+
+    def fit(self, docs, variant='standard', batch_size=16, cache_scores=False):
+        '''
+        Cluster the input documents
+        :param docs: list of list
+            list of lists containing the unique token set of each document
+        :param variant: 'standard', the only variant the jax sampler implements
+        :param batch_size: int
+            unused, accepted for compatibility with MovieGroupProcessArray.fit
+        :param cache_scores: bool
+            must be False, the jax sampler keeps no per-doc score cache
+        :return: np.ndarray of length len(doc)
+            cluster label for each document
+        '''
+        if variant != 'standard':
+            raise ValueError(f"the jax backend only supports variant='standard', got {variant!r}")
+        if cache_scores:
+            raise ValueError('the jax backend does not support cache_scores')
+
+        self.create_dictionary(docs)
+
+        alpha, beta, K, n_iters, V = self.alpha, self.beta, self.K, self.n_iters, self.vocab_size
+
+        D = len(self.corpus)
+        self.number_docs = D
+
+        # pad the docs to a (D, max doc size) shape, padding has count 0
+        doc_size = self._doc_size
+        doc_idx = np.zeros((D, max(doc_size.max(), 1)), dtype=np.int32)
+        doc_cnt = np.zeros_like(doc_idx)
+        for i in range(D):
+            doc_idx[i, :doc_size[i]] = self._doc_idx[i]
+            doc_cnt[i, :doc_size[i]] = self._doc_cnt[i]
+
+        # initialize the clusters, keys are seeded from numpy so np.random.seed applies
+        d_z = np.random.randint(K, size=D).astype(np.int32)
+        m_z = np.bincount(d_z, minlength=K).astype(np.int32)
+        n_z = np.bincount(d_z, weights=doc_size, minlength=K).astype(np.int32)
+        n_w_z = np.zeros((V, K), dtype=np.int32)
+        np.add.at(n_w_z, (doc_idx, d_z[:, None]), doc_cnt)
+        key = jax.random.PRNGKey(np.random.randint(2 ** 31 - 1))
+
+        d_z, m_z, n_z, n_w_z = (jnp.asarray(a) for a in (d_z, m_z, n_z, n_w_z))
+        doc_idx, doc_cnt, doc_size = (jnp.asarray(a) for a in (doc_idx, doc_cnt, doc_size))
+        cluster_count = K
+
+        for _iter in range(n_iters):
+            key, pass_key = jax.random.split(key)
+            d_z, m_z, n_z, n_w_z, total_transfers = _gibbs_pass(d_z, m_z, n_z, n_w_z, doc_idx, doc_cnt, doc_size,
+                                                                pass_key, alpha, beta, V)
+
+            total_transfers = int(total_transfers)
+            cluster_count_new = int((m_z > 0).sum())
+            print("In stage %d: transferred %d clusters with %d clusters populated" % (
+                _iter, total_transfers, cluster_count_new))
+            if total_transfers == 0 and cluster_count_new == cluster_count and _iter > 25:
+                print("Converged.  Breaking out.")
+                break
+            cluster_count = cluster_count_new
+
+        self.cluster_doc_count = np.asarray(m_z).astype(np.int64)
+        self.cluster_word_count = np.asarray(n_z).astype(np.int64)
+        # (K, V) view of the counts, no copy
+        self.cluster_word_distribution = np.asarray(n_w_z).T
+        return np.asarray(d_z)
@@ -0,0 +1,146 @@
+# cython: language_level=3
+'''
+Compiled versions of any2utf8, utf8_strict, any2utf8_list and any2unicode from gsdmm/utils/utils.py, which dispatch on the
+argument type and call the CPython codec functions directly. Both versions must stay in sync.
+'''
+
+
+from cpython.buffer cimport PyBuffer_FillInfo
+from cpython.bytes cimport PyBytes_AS_STRING, PyBytes_Check, PyBytes_FromStringAndSize, PyBytes_GET_SIZE
+
+
+cdef extern from "Python.h":
+    bint PyUnicode_Check(object o)
+    bint PyUnicode_IS_ASCII(object o)
+    void *PyUnicode_DATA(object o)
+    Py_ssize_t PyUnicode_GET_LENGTH(object o)
+    const char *PyUnicode_AsUTF8(object unicode) except NULL
+    const char *PyUnicode_AsUTF8AndSize(object unicode, Py_ssize_t *size) except NULL
+    object PyUnicode_AsUTF8String(object unicode)
+    object PyUnicode_FromEncodedObject(object obj, const char *encoding, const char *errors)
+    object PyUnicode_DecodeUTF8(const char *s, Py_ssize_t size, const char *errors)
+    object PyUnicode_DecodeLatin1(const char *s, Py_ssize_t size, const char *errors)
+    object PyUnicode_DecodeASCII(const char *s, Py_ssize_t size, const char *errors)
+
+
+# an exact type check against this is a single pointer comparison, PyUnicode_Check covers subclasses
+cdef object _str_type = str
+
+
+cdef inline str _normalize_encoding(str encoding):
+    # the spelling variants codecs accepts ('UTF-8', 'utf_8', 'Latin-1', ...) compare equal after this
+    return encoding.lower().replace('_', '-')
+
+
+cdef inline bint _is_utf8(str encoding):
+    return encoding == 'utf8' or _normalize_encoding(encoding) in ('utf8', 'utf-8')
+
+
+cdef str _decode(object text, str encoding, str errors):
+    '''
+    Decode a bytestring, calling the codec directly for the common encodings instead of looking it up.
+    '''
+    cdef const char *errs = PyUnicode_AsUTF8(errors)
+    cdef str enc
+    if PyBytes_Check(text):
+        enc = encoding if encoding == 'utf8' else _normalize_encoding(encoding)
+        if enc == 'utf8' or enc == 'utf-8':
+            return PyUnicode_DecodeUTF8(PyBytes_AS_STRING(text), PyBytes_GET_SIZE(text), errs)
+        if enc == 'latin1' or enc == 'latin-1':
+            return PyUnicode_DecodeLatin1(PyBytes_AS_STRING(text), PyBytes_GET_SIZE(text), errs)
+        if enc == 'ascii':
+            return PyUnicode_DecodeASCII(PyBytes_AS_STRING(text), PyBytes_GET_SIZE(text), errs)
+    return PyUnicode_FromEncodedObject(text, PyUnicode_AsUTF8(encoding), errs)
+
+
+cdef inline bytes _str2utf8(object text):
+    # ascii strings are stored one byte per character, which already is their utf8
+    if PyUnicode_IS_ASCII(text):
+        return PyBytes_FromStringAndSize(<char *>PyUnicode_DATA(text), PyUnicode_GET_LENGTH(text))
+    return PyUnicode_AsUTF8String(text)
+
+
+cpdef bytes any2utf8(object text, str errors='strict', str encoding='utf8', bint validate=False):
+    '''
+    Convert a unicode or bytes string in the given encoding into a utf8 bytestring.
+    See gsdmm.utils.utils.any2utf8 for the parameters.
+    '''
+    if type(text) is _str_type or PyUnicode_Check(text):
+        return _str2utf8(text)
+    if type(text) is bytes and errors == 'strict' and _is_utf8(encoding):
+        # already what was asked for, decode only to raise on invalid utf8
+        if validate:
+            PyUnicode_DecodeUTF8(PyBytes_AS_STRING(text), PyBytes_GET_SIZE(text), NULL)
+        return text
+    # do bytestring -> unicode -> utf8 full circle, to ensure valid utf8
+    return PyUnicode_AsUTF8String(_decode(text, encoding, errors))
+
+
+to_utf8 = any2utf8
+
+
+cpdef bytes utf8_strict(object text):
+    '''
+    any2utf8 with its default arguments, which is how it's almost always called.
+    '''
+    if type(text) is _str_type or PyUnicode_Check(text):
+        return _str2utf8(text)
+    if type(text) is bytes:
+        return text
+    return PyUnicode_AsUTF8String(PyUnicode_FromEncodedObject(text, 'utf8', NULL))
+
+
+cpdef object any2unicode(object text, str encoding='utf8', str errors='strict'):
+    '''
+    Convert `text` (bytestring in given encoding or unicode) to unicode.
+    See gsdmm.utils.utils.any2unicode for the parameters.
+    '''
+    if type(text) is _str_type or PyUnicode_Check(text):
+        return text
+    return _decode(text, encoding, errors)
+
+
+to_unicode = any2unicode
+
+
+def any2utf8_list(object texts, str errors='strict', str encoding='utf8'):
+    '''
+    any2utf8 over an iterable, calling the C function directly for every item.
+    '''
+    cdef list out = []
+    if errors == 'strict' and _is_utf8(encoding):
+        for text in texts:
+            out.append(utf8_strict(text))
+    else:
+        for text in texts:
+            out.append(any2utf8(text, errors, encoding))
+    return out
+
+
+cdef class _UTF8Buffer:
+    '''
+    Read-only buffer over the utf8 representation CPython caches on a str, holding a reference to
+    the str so the memory outlives it for as long as any view does.
+    '''
+    cdef object text
+    cdef const char *data
+    cdef Py_ssize_t size
+
+    def __getbuffer__(self, Py_buffer *buffer, int flags):
+        PyBuffer_FillInfo(buffer, self, <void *>self.data, self.size, 1, flags)
+
+    def __releasebuffer__(self, Py_buffer *buffer):
+        pass
+
+
+def any2utf8_view(object text):
+    '''
+    Zero-copy version of any2utf8 for callers that only read the bytes, e.g. to hash them.
+    The view keeps `text` alive, no bytes object is allocated.
+    '''
+    if not PyUnicode_Check(text):
+        raise TypeError('any2utf8_view() expects a str, got %s' % type(text).__name__)
+    cdef _UTF8Buffer buf = _UTF8Buffer.__new__(_UTF8Buffer)
+    buf.data = PyUnicode_AsUTF8AndSize(text, &buf.size)
+    buf.text = text
+    return memoryview(buf)
@@ -0,0 +1,235 @@
+"""Read local files through io_uring, keeping a ring of registered read buffers in flight.
+
+Linux only and needs the `liburing` package, without it (or for files that fit in one chunk) the reads
+fall back to `os.pread`.
+"""
+import errno
+import io
+import mmap
+import os
+import platform
+from collections import deque
+
+try:
+    if platform.system() != 'Linux' or not hasattr(os, 'eventfd'):
+        raise ImportError('io_uring is only available on Linux')
+    import liburing
+except ImportError:
+    liburing = None
+
+
+def _iter_chunks_pread(fd, size, chunk):
+    offset = 0
+    while offset < size:
+        data = os.pread(fd, chunk, offset)
+        if not data:
+            break
+        offset += len(data)
+        yield data
+
+
+def _setup_ring(fd, ring_depth, chunk, sqpoll=False, direct=False):
+    """Create the ring and register the file, buffers and completion eventfd with it.
+
+    Raises OSError when io_uring can't be used here, e.g. it's blocked by seccomp or the buffers go over
+    RLIMIT_MEMLOCK, after tearing down whatever was already set up.
+    """
+    if direct and chunk % mmap.PAGESIZE:
+        raise ValueError('direct reads need a chunk size that is a multiple of %d' % mmap.PAGESIZE)
+    if direct and not liburing.probe().get('IORING_OP_READV_FIXED'):
+        # added in Linux 6.15, older kernels would fail every read with EINVAL
+        raise OSError(errno.EINVAL, 'the kernel does not support IORING_OP_READV_FIXED')
+    ring = liburing.Ring()
+    liburing.io_uring_queue_init(ring_depth, ring, liburing.IORING_SETUP_SQPOLL if sqpoll else 0)
+    read_fd = efd = None
+    try:
+        # the ring reads straight into these, keep references to them until it's torn down
+        if direct:
+            # O_DIRECT needs page aligned memory, split one mmap arena into the fixed buffers
+            arena = mmap.mmap(-1, ring_depth * chunk)
+            buffers = [memoryview(arena)[slot * chunk:(slot + 1) * chunk] for slot in range(ring_depth)]
+            read_fd = os.open('/proc/self/fd/%d' % fd, os.O_RDONLY | os.O_DIRECT | os.O_CLOEXEC)
+        else:
+            buffers = [bytearray(chunk) for _ in range(ring_depth)]
+        # completions are signalled on this, blocking on it releases the GIL where io_uring_wait_cqe doesn't
+        efd = os.eventfd(0, os.EFD_CLOEXEC)
+        liburing.io_uring_register_files(ring, liburing.FileIndex([fd if read_fd is None else read_fd]))
+        liburing.io_uring_register_buffers(ring, liburing.Iovec(buffers))
+        liburing.io_uring_register_eventfd(ring, efd)
+    except BaseException:
+        _teardown_ring(ring, efd, read_fd)
+        raise
+    return ring, buffers, efd, read_fd
+
+
+def _teardown_ring(ring, efd, read_fd):
+    liburing.io_uring_queue_exit(ring)
+    if efd is not None:
+        os.close(efd)
+    if read_fd is not None:
+        os.close(read_fd)
+
+
+def _iter_chunks_uring(fd, size, ring, buffers, efd, read_fd, chunk):
+    direct = read_fd is not None
+    cqe = liburing.Cqe()
+    if direct:
+        slot_iovecs = [liburing.Iovec([buffer]) for buffer in buffers]
+    try:
+        # reads are queued in file order, each one into the buffer (slot) it's user_data points to
+        in_flight = deque()
+        completed = {}
+        unsubmitted = 0
+        next_offset = 0
+
+        def prep(slot):
+            nonlocal next_offset, unsubmitted
+            sqe = liburing.io_uring_get_sqe(ring)
+            if direct:
+                liburing.io_uring_prep_readv_fixed(sqe, 0, slot_iovecs[slot], slot, next_offset)
+            else:
+                liburing.io_uring_prep_read_fixed(sqe, 0, buffers[slot], slot, next_offset)
+            liburing.io_uring_sqe_set_flags(sqe, liburing.IOSQE_FIXED_FILE)
+            sqe.user_data = slot
+            in_flight.append((slot, next_offset, min(chunk, size - next_offset)))
+            next_offset += chunk
+            unsubmitted += 1
+
+        def harvest():
+            # only cqe[0] is safe to read, the completion queue wraps around
+            while liburing.io_uring_cq_ready(ring):
+                liburing.io_uring_peek_cqe(ring, cqe)
+                entry = cqe[0]
+                completed[entry.user_data] = entry.res
+                liburing.io_uring_cqe_seen(ring, entry)
+
+        for slot in range(len(buffers)):
+            if next_offset >= size:
+                break
+            prep(slot)
+        liburing.io_uring_submit(ring)
+        unsubmitted = 0
+
+        while in_flight:
+            slot, offset, length = in_flight.popleft()
+            if slot not in completed:
+                harvest()
+            while slot not in completed:
+                # about to block, flush the queued reads first
+                if unsubmitted:
+                    liburing.io_uring_submit(ring)
+                    unsubmitted = 0
+                while not liburing.io_uring_cq_ready(ring):
+                    os.eventfd_read(efd)
+                harvest()
+
+            res = completed.pop(slot)
+            if res < 0:
+                raise OSError(-res, os.strerror(-res))
+            # copy out before the buffer gets reused
+            data = bytes(memoryview(buffers[slot])[:res])
+            if 0 < res < length:
+                # short read, get the rest of the chunk directly
+                data += os.pread(fd, length - res, offset + res)
+
+            if next_offset < size:
+                prep(slot)
+                # batch more submissions while plenty of reads are still running in the kernel
+                # compared to completed ones waiting to be consumed
+                outstanding = len(in_flight) - len(completed) - unsubmitted
+                batch_size = min(max(outstanding // max(len(completed), 1), 1), 32)
+                if unsubmitted >= batch_size:
+                    liburing.io_uring_submit(ring)
+                    unsubmitted = 0
+            if not data:
+                break
+            yield data
+    finally:
+        _teardown_ring(ring, efd, read_fd)
+
+
+def _iter_chunks(fd, ring_depth, chunk, sqpoll=False, direct=False):
+    size = os.fstat(fd).st_size
+    if liburing is None or size <= chunk:
+        yield from _iter_chunks_pread(fd, size, chunk)
+        return
+    try:
+        ring, buffers, efd, read_fd = _setup_ring(fd, ring_depth, chunk, sqpoll, direct)
+    except OSError:
+        # io_uring is refused here (seccomp, RLIMIT_MEMLOCK, an old kernel), read with pread instead
+        yield from _iter_chunks_pread(fd, size, chunk)
+        return
+    yield from _iter_chunks_uring(fd, size, ring, buffers, efd, read_fd, chunk)
+
+
+def iter_lines_uring(path, ring_depth=32, chunk=1 << 20, sqpoll=False, direct=False):
+    """Iterate over the lines of a local file, reading it in `chunk` sized blocks with up to `ring_depth` in flight.
+
+    Parameters
+    ----------
+    path : str
+        Path to a local file.
+    ring_depth : int, optional
+        Number of reads kept in flight.
+    chunk : int, optional
+        Size of each read in bytes.
+    sqpoll : bool, optional
+        Let a kernel thread poll the submission queue, so steady state reads need no `io_uring_enter` syscall.
+    direct : bool, optional
+        Read with O_DIRECT into page aligned buffers, bypassing the page cache. `chunk` has to be a multiple of
+        the page size, and the kernel needs IORING_OP_READV_FIXED (Linux 6.15+), without it the file is read
+        with `os.pread`.
+
+    Yields
+    ------
+    bytes
+        Lines of the file, including the trailing newline.
+
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        tail = b''
+        for data in _iter_chunks(fd, ring_depth, chunk, sqpoll, direct):
+            lines = data.split(b'\n')
+            lines[0] = tail + lines[0]
+            tail = lines.pop()
+            for line in lines:
+                yield line + b'\n'
+        if tail:
+            yield tail
+    finally:
+        os.close(fd)
+
+
+class UringFile(io.RawIOBase):
+    """Read-only raw file served from the io_uring read-ahead, wrap it in `io.BufferedReader` for line iteration."""
+
+    def __init__(self, path, ring_depth=32, chunk=1 << 20, sqpoll=False, direct=False):
+        self.name = path
+        self._fd = os.open(path, os.O_RDONLY)
+        self._chunks = _iter_chunks(self._fd, ring_depth, chunk, sqpoll, direct)
+        self._pending = memoryview(b'')
+
+    def readable(self):
+        return True
+
+    def fileno(self):
+        return self._fd
+
+    def readinto(self, b):
+        while not self._pending:
+            data = next(self._chunks, None)
+            if data is None:
+                return 0
+            self._pending = memoryview(data)
+        n = min(len(b), len(self._pending))
+        b[:n] = self._pending[:n]
+        self._pending = self._pending[n:]
+        return n
+
+    def close(self):
+        if not self.closed:
+            # tear the ring down before the file it has registered
+            self._chunks.close()
+            os.close(self._fd)
+        super().close()
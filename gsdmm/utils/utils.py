@@ -1,65 +1,179 @@
-import sys
-from contextlib import contextmanager
-from six import string_types, iteritems
+import functools
+import io
+import mmap
+import os
+
+import numpy as np
 from smart_open import open
+from smart_open.compression import get_supported_extensions
 
-if sys.version_info[0] >= 3:
-    unicode = str
+from . import _uring_reader
 
 """pieces taken from gensim.utils.py"""
 
+# with prefer_mmap, local files from this size on are read through io_uring instead
+_MMAP_MAX_SIZE = 100 << 20
+
+
+def _open_local(path):
+    return io.open(path, 'rb', buffering=1 << 20)
+
+
+def _open_smart(path):
+    return open(path, 'rb')
+
+
+@functools.lru_cache(maxsize=16)
+def _resolve_opener(scheme, ext):
+    """Pick the opener for paths with the given URI scheme ('' for local paths) and lowercase extension.
+    Only local paths without a compression extension smart_open knows skip smart_open."""
+    if scheme == '' and ext not in get_supported_extensions():
+        return _open_local
+    return _open_smart
+
+
+class _MappedFile(mmap.mmap):
+    """Read-only map that iterates over lines like a file opened in binary mode, rather than single bytes."""
+
+    def __iter__(self):
+        size = len(self)
+        start = self.tell()
+        while start < size:
+            end = self.find(b'\n', start)
+            end = size if end < 0 else end + 1
+            self.seek(end)
+            yield self[start:end]
+            start = end
+
+
+def mmap_file(path):
+    """Memory-map a local file read-only, advised for sequential access.
+
+    Parameters
+    ----------
+    path : str
+        Path to a non-empty local file.
+
+    Returns
+    -------
+    mmap.mmap
+        File-like map of the whole file, positioned at the beginning. Iterating over it yields lines.
+
+    """
+    fd = os.open(path, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+    try:
+        if hasattr(mmap, 'MAP_SHARED'):
+            mm = _MappedFile(fd, 0, flags=mmap.MAP_SHARED | getattr(mmap, 'MAP_POPULATE', 0), prot=mmap.PROT_READ)
+        else:
+            # Windows has no flags or prot
+            mm = _MappedFile(fd, 0, access=mmap.ACCESS_READ)
+    finally:
+        # the map keeps its own reference to the file
+        os.close(fd)
+    if hasattr(mm, 'madvise'):
+        mm.madvise(mmap.MADV_SEQUENTIAL)
+    return mm
+
 
-def file_or_filename(input):
-    """Open a filename for reading with `smart_open`, or seek to the beginning if `input` is an already open file.
+def file_or_filename(input, use_uring=False, prefer_mmap=False):
+    """Open a filename for reading, or seek to the beginning if `input` is an already open file.
+
+    Non-seekable file-like objects (pipes, sockets, stdin) are returned as they are, and read from their
+    current position.
 
     Parameters
     ----------
     input : str or file-like
         Filename or file-like object.
+    use_uring : bool, optional
+        Read plain local files through io_uring (Linux with the `liburing` package, `os.pread` otherwise).
+    prefer_mmap : bool, optional
+        Memory-map plain local files smaller than 100 MB (see `mmap_file`), and read larger ones through
+        io_uring.
 
     Returns
     -------
     file-like object
         An open file, positioned at the beginning.
 
+    Notes
+    -----
+    Plain local files are opened with the builtin `open` and a 1 MiB buffer, URIs and compressed files
+    go through `smart_open`.
+
     """
-    if isinstance(input, string_types):
+    if isinstance(input, str):
         # input was a filename: open as file
-        return open(input, 'rb')
+        scheme = input.split('://', 1)[0] if '://' in input else ''
+        if not scheme:
+            # like smart_open does for local paths
+            input = os.path.expanduser(input)
+        opener = _resolve_opener(scheme, os.path.splitext(input)[1].lower())
+        if opener is _open_local:
+            if prefer_mmap and not use_uring:
+                size = os.path.getsize(input)
+                if 0 < size < _MMAP_MAX_SIZE:
+                    return mmap_file(input)
+                use_uring = size >= _MMAP_MAX_SIZE
+            if use_uring:
+                return io.BufferedReader(_uring_reader.UringFile(input), buffer_size=1 << 20)
+        return opener(input)
     else:
-        # input already a file-like object; just reset to the beginning
-        input.seek(0)
+        # input already a file-like object; just reset to the beginning if it can
+        if hasattr(input, 'seekable') and input.seekable():
+            input.seek(0)
         return input
 
 
-@contextmanager
-def open_file(input):
+class _OpenFile(object):
+    """Context manager behind `open_file`."""
+    __slots__ = ('_input', '_use_uring', '_prefer_mmap', '_f', '_pos')
+
+    def __init__(self, input, use_uring=False, prefer_mmap=False):
+        self._input = input
+        self._use_uring = use_uring
+        self._prefer_mmap = prefer_mmap
+
+    def __enter__(self):
+        if isinstance(self._input, str):
+            self._f = file_or_filename(self._input, use_uring=self._use_uring, prefer_mmap=self._prefer_mmap)
+        else:
+            self._f = self._input
+            self._pos = None
+            if hasattr(self._f, 'seekable') and self._f.seekable():
+                self._pos = self._f.tell()
+                self._f.seek(0)
+        return self._f
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self._f is not self._input:
+            self._f.close()
+        elif self._pos is not None:
+            self._f.seek(self._pos)
+        # exceptions from the with block are never swallowed
+        return False
+
+
+def open_file(input, use_uring=False, prefer_mmap=False):
     """Provide "with-like" behaviour without closing the file object.
 
+    Files opened from a filename are closed on exit, seekable file-like objects are rewound on entry and
+    moved back to the caller's position on exit. Non-seekable ones are read from their current position.
+
     Parameters
     ----------
     input : str or file-like
         Filename or file-like object.
+    use_uring, prefer_mmap : bool, optional
+        Passed on to `file_or_filename`.
 
-    Yields
+    Returns
     -------
-    file
-        File-like object based on input (or input if this already file-like).
+    context manager
+        Yields a file-like object based on input (or input if this already file-like).
 
     """
-    mgr = file_or_filename(input)
-    exc = False
-    try:
-        yield mgr
-    except Exception:
-        # Handling any unhandled exceptions from the code nested in 'with' statement.
-        exc = True
-        if not isinstance(input, string_types) or not mgr.__exit__(*sys.exc_info()):
-            raise
-        # Try to introspect and silence errors.
-    finally:
-        if not exc and isinstance(input, string_types):
-            mgr.__exit__(None, None, None)
+    return _OpenFile(input, use_uring, prefer_mmap)
 
 
 def revdict(d):
@@ -89,10 +203,15 @@ def revdict(d):
         {2: 1, 4: 3}
 
     """
-    return {v: k for (k, v) in iteritems(dict(d))}
+    return {v: k for (k, v) in d.items()}
+
+
+def _is_utf8(encoding):
+    """Whether `encoding` names utf8, however it is spelled ('utf8', 'UTF-8', 'utf_8', ...)."""
+    return encoding == 'utf8' or encoding.lower().replace('_', '-') in ('utf8', 'utf-8')
 
 
-def any2utf8(text, errors='strict', encoding='utf8'):
+def any2utf8(text, errors='strict', encoding='utf8', validate=False):
     """Convert a unicode or bytes string in the given encoding into a utf8 bytestring.
 
     Parameters
@@ -103,6 +222,8 @@ def any2utf8(text, errors='strict', encoding='utf8'):
         Error handling behaviour if `text` is a bytestring.
     encoding : str, optional
         Encoding of `text` if it is a bytestring.
+    validate : bool, optional
+        Check that a utf8 bytestring is valid before returning it as is, with strict error handling.
 
     Returns
     -------
@@ -111,15 +232,41 @@ def any2utf8(text, errors='strict', encoding='utf8'):
 
     """
 
-    if isinstance(text, unicode):
+    if isinstance(text, str):
         return text.encode('utf8')
+    if type(text) is bytes and errors == 'strict' and _is_utf8(encoding):
+        # already what was asked for, decode only to raise on invalid utf8
+        if validate:
+            text.decode('utf8')
+        return text
     # do bytestring -> unicode -> utf8 full circle, to ensure valid utf8
-    return unicode(text, encoding, errors=errors).encode('utf8')
+    return str(text, encoding, errors=errors).encode('utf8')
 
 
 to_utf8 = any2utf8
 
 
+def utf8_strict(text):
+    """`any2utf8` with its default arguments, which is how it's almost always called.
+
+    Parameters
+    ----------
+    text : str
+        Input text.
+
+    Returns
+    -------
+    str
+        Bytestring in utf8.
+
+    """
+    if isinstance(text, str):
+        return text.encode('utf8')
+    if type(text) is bytes:
+        return text
+    return str(text, 'utf8').encode('utf8')
+
+
 def any2unicode(text, encoding='utf8', errors='strict'):
     """Convert `text` (bytestring in given encoding or unicode) to unicode.
     Parameters
@@ -141,3 +288,73 @@ def any2unicode(text, encoding='utf8', errors='strict'):
 
 
 to_unicode = any2unicode
+
+
+def any2utf8_view(text):
+    """Get a read-only utf8 view of `text`, for callers that don't need a bytes object, e.g. to hash it.
+
+    Parameters
+    ----------
+    text : str
+        Input text.
+
+    Returns
+    -------
+    memoryview
+        utf8 bytes of `text`. The compiled version shares the memory of `text` instead of copying it.
+
+    """
+    return memoryview(text.encode('utf8'))
+
+
+def any2utf8_list(texts, errors='strict', encoding='utf8'):
+    """Apply `any2utf8` to every item of `texts`, see `any2utf8_batch`."""
+    if errors == 'strict' and _is_utf8(encoding):
+        return [utf8_strict(text) for text in texts]
+    return [any2utf8(text, errors=errors, encoding=encoding) for text in texts]
+
+
+def _arrow_to_utf8(arr):
+    """Slice the utf8 entries straight out of a pyarrow (large) string array's data buffer, nulls become None."""
+    _, offsets, data = arr.buffers()
+    offset_type = np.int64 if type(arr).__name__ == 'LargeStringArray' else np.int32
+    offsets = np.frombuffer(offsets, dtype=offset_type)[arr.offset:arr.offset + len(arr) + 1].tolist()
+    data = memoryview(data) if data is not None else memoryview(b'')
+    result = [data[start:end].tobytes() for start, end in zip(offsets, offsets[1:])]
+    if arr.null_count:
+        for i in np.flatnonzero(arr.is_null().to_numpy(zero_copy_only=False)).tolist():
+            result[i] = None
+    return result
+
+
+def any2utf8_batch(texts, errors='strict', encoding='utf8'):
+    """Convert many unicode or bytes strings to utf8 bytestrings at once.
+
+    Parameters
+    ----------
+    texts : iterable of str, numpy.ndarray or pyarrow.StringArray
+        Input texts.
+    errors : str, optional
+        Error handling behaviour for bytestrings in `texts`.
+    encoding : str, optional
+        Encoding of bytestrings in `texts`.
+
+    Returns
+    -------
+    list of bytes
+        Bytestrings in utf8. pyarrow string arrays already hold utf8, their entries are copied out without
+        re-encoding and nulls are returned as None.
+
+    """
+    if type(texts).__module__.startswith('pyarrow') and type(texts).__name__ in ('StringArray', 'LargeStringArray'):
+        return _arrow_to_utf8(texts)
+    if isinstance(texts, np.ndarray):
+        texts = texts.ravel()
+    return any2utf8_list(texts, errors=errors, encoding=encoding)
+
+
+# prefer the compiled conversions when the extension is built
+try:
+    from ._futf8 import any2utf8, any2unicode, any2utf8_list, any2utf8_view, to_unicode, to_utf8, utf8_strict
+except ImportError:
+    pass
@@ -1,18 +1,32 @@
-from setuptools import setup
+from setuptools import setup, Extension
 
 VERSION=0.1
 INSTALL_REQUIRES = [
-    'numpy'
+    'numpy',
+    'scipy'
 ]
 
+# the compiled extensions are optional, without Cython fit falls back to the numba kernel (the 'numba' extra)
+# and gsdmm.utils to the pure-Python conversions
+try:
+    from Cython.Build import cythonize
+    EXT_MODULES = cythonize([
+        Extension('gsdmm._gibbs', ['gsdmm/_gibbs.pyx']),
+        Extension('gsdmm.utils._futf8', ['gsdmm/utils/_futf8.pyx']),
+    ])
+except ImportError:
+    EXT_MODULES = []
+
 setup(
     name='gsdmm',
-    packages=['gsdmm'],
+    packages=['gsdmm', 'gsdmm.utils'],
     version=0.1,
     url='https://www.github.com/rwalk/gsdmm',
     author='Ryan Walker',
     author_email='ryan@ryanwalker.us',
     description='GSDMM: Short text clustering ',
     license='MIT',
-    install_requires=INSTALL_REQUIRES
+    install_requires=INSTALL_REQUIRES,
+    extras_require={'jax': ['jax'], 'numba': ['numba']},
+    ext_modules=EXT_MODULES
 )